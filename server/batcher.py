@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from .database import DatabaseManager, now_us
+
+logger = logging.getLogger("PPAH_DB")
+
+_STOP = None
+
+class SessionWriteBatcher:
+    """Coalesces verify-hash writes into one executemany transaction.
+
+    A batch is flushed flush_interval after its first write, or as soon as max_batch
+    writes are waiting, whichever comes first.
+
+    Endpoints update the session cache synchronously and enqueue the DB write, so
+    the ordering check never waits on SQLite and fsyncs are shared across requests.
+    The queue is bounded: if SQLite falls behind, submit() waits for room instead of
+    letting pending writes grow without limit.
+
+    The queue and event are created in start(), on the running loop, so the batcher
+    can be started again under a new loop (e.g. one lifespan per TestClient).
+    """
+
+    def __init__(self, flush_interval: float = 0.05, max_batch: int = 128, max_pending: int = 10_000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.queue: asyncio.Queue = None
+        self._full: asyncio.Event = None
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+            self._full = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._on_done)
+
+    async def stop(self):
+        # The sentinel lets the loop flush everything queued before it, then exit.
+        if self._task is not None:
+            if not self._task.done():
+                self._stopping = True
+                self._full.set()
+                await self.queue.put(_STOP)
+                await asyncio.wait([self._task])
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def _on_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Write batcher stopped; session writes are no longer persisted",
+                         exc_info=task.exception())
+
+    async def submit(self, session_id, segments, trust_score, status, freeze_reason, anomalies=()):
+        # Refuse rather than queue into a dead loop: nothing would ever drain it, and
+        # once the queue filled every caller would block forever.
+        if not self.running:
+            raise RuntimeError("Write batcher is not running")
+        await self.queue.put((session_id, segments, trust_score, status, freeze_reason, anomalies, now_us()))
+        if self.queue.qsize() >= self.max_batch:
+            self._full.set()
+
+    def _drain(self, first):
+        items, stopping = [], first is _STOP
+        if not stopping:
+            items.append(first)
+        while len(items) < self.max_batch and not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is _STOP:
+                stopping = True
+            else:
+                items.append(item)
+        return items, stopping
+
+    @staticmethod
+    def _flush(items):
+        if not items:
+            return
+        try:
+            DatabaseManager.write_segments(items)
+        except Exception:
+            logger.exception("Dropped %d queued session writes", len(items))
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            if first is not _STOP and not self._stopping and self.queue.qsize() + 1 < self.max_batch:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            items, stopping = self._drain(first)
+            await asyncio.to_thread(self._flush, items)
+            if stopping:
+                return
+
+batcher = SessionWriteBatcher()
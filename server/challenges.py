@@ -0,0 +1,50 @@
+import os
+from typing import Optional
+
+from cachetools import TTLCache
+
+from .redis_client import REDIS_URL, get_redis
+
+# A WebAuthn ceremony has to finish within this window after its options are issued.
+CHALLENGE_TTL = 300
+# "memory" or "redis"; Redis is the default whenever REDIS_URL is configured.
+CHALLENGE_BACKEND = os.getenv("CHALLENGE_BACKEND", "redis" if REDIS_URL else "memory").lower()
+
+class MemoryChallengeStore:
+    """Per-process challenge store; fine for the default single-worker server.
+
+    Bounded and expiring like the Redis store, so abandoned ceremonies (or a script
+    enumerating emails) cannot grow it without limit.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.challenges: TTLCache = TTLCache(maxsize=maxsize, ttl=CHALLENGE_TTL)
+
+    async def put(self, email: str, challenge: bytes):
+        self.challenges[email] = challenge
+
+    async def pop(self, email: str) -> Optional[bytes]:
+        return self.challenges.pop(email, None)
+
+class RedisChallengeStore:
+    """Challenges in Redis with a server-side TTL, shared by every worker behind the same REDIS_URL.
+
+    The client is looked up on every call rather than held: close_redis() drops it at
+    the end of each lifespan, and the next lifespan's client belongs to a new loop.
+    """
+
+    async def put(self, email: str, challenge: bytes):
+        await get_redis().set(f"chal:{email}", challenge, ex=CHALLENGE_TTL)
+
+    async def pop(self, email: str) -> Optional[bytes]:
+        # GETDEL (Redis >= 6.2): one round trip, and two workers can never both claim it.
+        return await get_redis().getdel(f"chal:{email}")
+
+def create_challenge_store():
+    if CHALLENGE_BACKEND == "redis":
+        if not REDIS_URL:
+            raise RuntimeError("CHALLENGE_BACKEND=redis requires REDIS_URL")
+        return RedisChallengeStore()
+    return MemoryChallengeStore()
+
+challenge_store = create_challenge_store()
@@ -1,44 +1,235 @@
-import sqlite3
+import hmac
 import logging
+import threading
+import time
+
+from cachetools import TTLCache
+
+from .db_pool import get_conn, init_pool
 
-DB_NAME = "ppah_enterprise.db"
 logger = logging.getLogger("PPAH_DB")
 
+SCHEMA_VERSION = 4
+
+# Runtime statements, kept as module constants so each is one identical string that
+# stays compiled in every pooled connection's statement cache.
+SQL_CREDENTIAL_IDS = "SELECT id FROM credentials WHERE user_email = ?"
+SQL_LOAD_CREDENTIAL = "SELECT public_key, sign_count FROM credentials WHERE id = ?"
+SQL_UPSERT_CREDENTIAL = '''INSERT INTO credentials (id, user_email, public_key, sign_count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET user_email = excluded.user_email,
+        public_key = excluded.public_key, sign_count = excluded.sign_count'''
+SQL_UPDATE_SIGN_COUNT = "UPDATE credentials SET sign_count = ? WHERE id = ?"
+SQL_LOAD_SESSION = '''SELECT session_key, status, freeze_reason, last_trust_score, segment_count, data
+    FROM sessions WHERE session_id = ?'''
+SQL_UPSERT_SESSION = '''INSERT INTO sessions (session_id, session_key, status, freeze_reason,
+        last_trust_score, segment_count, last_activity, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(session_id) DO UPDATE SET session_key = excluded.session_key,
+        status = excluded.status, freeze_reason = excluded.freeze_reason,
+        last_trust_score = excluded.last_trust_score, segment_count = excluded.segment_count,
+        last_activity = excluded.last_activity, data = excluded.data'''
+SQL_SESSION_AUTH = "SELECT session_key, status, segment_count FROM sessions WHERE session_id = ?"
+# The segment_count guard keeps a late write from rolling a session back.
+SQL_ADVANCE_SESSION = '''UPDATE sessions
+    SET segment_count = ?, last_trust_score = ?, status = ?, freeze_reason = ?, last_activity = ?
+    WHERE session_id = ? AND segment_count < ?'''
+SQL_INSERT_CHAIN = "INSERT OR IGNORE INTO hash_chain (session_id, segment_id, hash, ts) VALUES (?, ?, ?, ?)"
+SQL_INSERT_ANOMALY = "INSERT OR IGNORE INTO anomaly_log (session_id, segment_id, reason, ts) VALUES (?, ?, ?, ?)"
+# LIMIT -1 is SQLite for "no limit"; callers on the request path always pass a page size.
+SQL_HASH_CHAIN_PAGE = "SELECT segment_id, hash, ts FROM hash_chain WHERE session_id = ? ORDER BY segment_id LIMIT ? OFFSET ?"
+SQL_ANOMALY_PAGE = "SELECT segment_id, reason, ts FROM anomaly_log WHERE session_id = ? ORDER BY segment_id LIMIT ? OFFSET ?"
+
+# (keyed HMAC template, status, segment_count) per session_id. Verify-hash updates it
+# write-through ahead of the batched DB write, so it is the authority for ordering
+# checks. Kept short-lived so a session revoked by another process stops verifying
+# within the TTL.
+SESSION_CACHE_TTL = 60
+_session_cache = TTLCache(maxsize=10_000, ttl=SESSION_CACHE_TTL)
+_session_cache_lock = threading.RLock()
+
+def now_us() -> int:
+    """Current time as integer microseconds since the epoch; what every timestamp column stores."""
+    return time.time_ns() // 1000
+
+def _auth_entry(row):
+    # The HMAC key is the UTF-8 encoding of the hex session key (same as the client's
+    # importKey). Keying the HMAC once here lets each verify .copy() the template
+    # instead of re-deriving the inner/outer pads.
+    return (hmac.new(row[0].encode('utf-8'), digestmod='sha256'), row[1], row[2])
+
 class DatabaseManager:
     @staticmethod
     def init_db():
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute('''CREATE TABLE IF NOT EXISTS sessions 
-                         (session_id TEXT PRIMARY KEY, data TEXT, updated_at TIMESTAMP)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS credentials
-                         (id BLOB PRIMARY KEY, user_email TEXT, public_key BLOB, sign_count INTEGER)''')
-            conn.commit()
+        init_pool()
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                DatabaseManager._migrate_sessions_v1(conn)
+            if version < 2:
+                DatabaseManager._migrate_chain_v2(conn)
+            if version < 3:
+                DatabaseManager._migrate_epoch_v3(conn)
+            if version < 4:
+                DatabaseManager._migrate_without_rowid_v4(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @staticmethod
+    def _migrate_sessions_v1(conn):
+        # v1 splits the hot, per-segment fields out of the JSON blob into real columns
+        # so verify-hash can read and update them without (de)serializing the session.
+        legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sessions'").fetchone()
+        if legacy:
+            conn.execute("ALTER TABLE sessions RENAME TO sessions_legacy")
+        conn.execute('''CREATE TABLE sessions
+                        (session_id TEXT PRIMARY KEY, session_key TEXT, status TEXT, freeze_reason TEXT,
+                         last_trust_score INTEGER, segment_count INTEGER, last_activity INTEGER, data BLOB)''')
+        if legacy:
+            conn.execute('''INSERT INTO sessions
+                            SELECT session_id, json_extract(data, '$.session_key'), json_extract(data, '$.status'),
+                                   json_extract(data, '$.freeze_reason'),
+                                   COALESCE(json_extract(data, '$.last_trust_score'), 100), 0, updated_at,
+                                   json_object('email', json_extract(data, '$.email'),
+                                               'webauthn_id', json_extract(data, '$.webauthn_id'),
+                                               'created_at', json_extract(data, '$.created_at'))
+                            FROM sessions_legacy''')
+            conn.execute("DROP TABLE sessions_legacy")
+            logger.info("Migrated sessions table to schema v1")
+
+    @staticmethod
+    def _migrate_chain_v2(conn):
+        # Append-only side tables: one row per accepted segment / freeze event, so the
+        # session row stays O(1)-sized however long the session runs.
+        conn.execute('''CREATE TABLE IF NOT EXISTS hash_chain
+                        (session_id TEXT, segment_id INTEGER, hash TEXT, ts INTEGER,
+                         PRIMARY KEY (session_id, segment_id)) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS anomaly_log
+                        (session_id TEXT, segment_id INTEGER, reason TEXT, ts INTEGER,
+                         PRIMARY KEY (session_id, segment_id)) WITHOUT ROWID''')
+
+    @staticmethod
+    def _migrate_epoch_v3(conn):
+        # v3 stores every timestamp as integer microseconds since the epoch (see now_us).
+        to_us = "CAST((julianday({0}, 'utc') - 2440587.5) * 86400000000 AS INTEGER)"
+        created_at = "json_extract(CAST(data AS TEXT), '$.created_at')"
+        conn.execute(f"UPDATE sessions SET last_activity = {to_us.format('last_activity')} "
+                     "WHERE typeof(last_activity) = 'text'")
+        conn.execute(f"UPDATE sessions SET data = json_set(CAST(data AS TEXT), '$.created_at', {to_us.format(created_at)}) "
+                     f"WHERE typeof({created_at}) = 'text'")
+        for table in ("hash_chain", "anomaly_log"):
+            conn.execute(f"UPDATE {table} SET ts = {to_us.format('ts')} WHERE typeof(ts) = 'text'")
+
+    @staticmethod
+    def _migrate_without_rowid_v4(conn):
+        # Both tables are only ever reached through their TEXT/BLOB primary key, so
+        # clustering rows on that key drops the separate rowid B-tree and its lookups.
+        tables = {
+            'credentials': '''CREATE TABLE credentials
+                              (id BLOB PRIMARY KEY, user_email TEXT, public_key BLOB, sign_count INTEGER) WITHOUT ROWID''',
+            'sessions': '''CREATE TABLE sessions
+                           (session_id TEXT PRIMARY KEY, session_key TEXT, status TEXT, freeze_reason TEXT,
+                            last_trust_score INTEGER, segment_count INTEGER, last_activity INTEGER, data BLOB) WITHOUT ROWID''',
+        }
+        for table, ddl in tables.items():
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            if exists:
+                conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v3")
+            conn.execute(ddl)
+            if exists:
+                conn.execute(f"INSERT INTO {table} SELECT * FROM {table}_v3")
+                conn.execute(f"DROP TABLE {table}_v3")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_credentials_email ON credentials(user_email)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity)")
 
     @staticmethod
     def get_credential(email: str):
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id FROM credentials WHERE user_email = ?", (email,))
-            return c.fetchall()
+        """Raw credential ids (bytes) registered for email."""
+        with get_conn() as conn:
+            return [row[0] for row in conn.execute(SQL_CREDENTIAL_IDS, (email,))]
 
     @staticmethod
     def get_credential_by_id(cred_id: bytes):
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("SELECT public_key, sign_count FROM credentials WHERE id = ?", (cred_id,))
-            return c.fetchone()
+        with get_conn() as conn:
+            return conn.execute(SQL_LOAD_CREDENTIAL, (cred_id,)).fetchone()
 
     @staticmethod
     def save_credential(cred_id, email, public_key, sign_count):
-        with sqlite3.connect(DB_NAME) as conn:
-            c = conn.cursor()
-            c.execute("INSERT OR REPLACE INTO credentials (id, user_email, public_key, sign_count) VALUES (?, ?, ?, ?)",
-                      (cred_id, email, public_key, sign_count))
-            conn.commit()
-    
+        # UPSERT rewrites the row in place; INSERT OR REPLACE would delete and reinsert it.
+        with get_conn() as conn:
+            conn.execute(SQL_UPSERT_CREDENTIAL, (cred_id, email, public_key, sign_count))
+
     @staticmethod
     def update_sign_count(new_count, cred_id):
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.execute("UPDATE credentials SET sign_count = ? WHERE id = ?", (new_count, cred_id))
-            conn.commit()
+        with get_conn() as conn:
+            conn.execute(SQL_UPDATE_SIGN_COUNT, (new_count, cred_id))
+
+    @staticmethod
+    def load_session(session_id: str):
+        """(session_key, status, freeze_reason, last_trust_score, segment_count, data) or None."""
+        with get_conn() as conn:
+            return conn.execute(SQL_LOAD_SESSION, (session_id,)).fetchone()
+
+    @staticmethod
+    def save_session(session_id, session_key, status, freeze_reason, last_trust_score, segment_count, data):
+        with get_conn() as conn:
+            conn.execute(SQL_UPSERT_SESSION, (session_id, session_key, status, freeze_reason,
+                                              last_trust_score, segment_count, now_us(), data))
+        DatabaseManager.invalidate_session(session_id)
+
+    @staticmethod
+    def get_session_auth(session_id: str):
+        """(keyed HMAC template, status, segment_count) for the verify-hash hot path."""
+        with _session_cache_lock:
+            cached = _session_cache.get(session_id)
+        if cached:
+            return cached
+        with get_conn() as conn:
+            row = conn.execute(SQL_SESSION_AUTH, (session_id,)).fetchone()
+        if row:
+            # setdefault: if a verify advanced the entry while we were reading, keep it;
+            # the DB row may predate writes still sitting in the batcher.
+            with _session_cache_lock:
+                row = _session_cache.setdefault(session_id, _auth_entry(row))
+        return row
+
+    @staticmethod
+    def cached_session_auth(session_id: str):
+        """Cache-only lookup; never touches SQLite, so it is safe to call on the event loop."""
+        with _session_cache_lock:
+            return _session_cache.get(session_id)
+
+    @staticmethod
+    def advance_session(session_id: str, mac, status: str, segment_count: int):
+        """Publish a verified segment to the cache; the DB write follows via the write batcher."""
+        with _session_cache_lock:
+            _session_cache[session_id] = (mac, status, segment_count)
+
+    @staticmethod
+    def write_segments(items):
+        """Persist queued (session_id, segments, trust_score, status, freeze_reason, anomalies, ts)
+        tuples in one transaction. segments/anomalies are ascending (segment_id, value) pairs."""
+        updates, chain, anomalies = [], [], []
+        for session_id, segments, trust_score, status, freeze_reason, anomaly_list, ts in items:
+            updates.append((segments[-1][0], trust_score, status, freeze_reason, ts, session_id, segments[0][0]))
+            chain.extend((session_id, seg, h, ts) for seg, h in segments)
+            anomalies.extend((session_id, seg, reason, ts) for seg, reason in anomaly_list)
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(SQL_ADVANCE_SESSION, updates)
+            conn.executemany(SQL_INSERT_CHAIN, chain)
+            if anomalies:
+                conn.executemany(SQL_INSERT_ANOMALY, anomalies)
+
+    @staticmethod
+    def get_hash_chain(session_id: str, offset: int = 0, limit: int = -1):
+        with get_conn() as conn:
+            return conn.execute(SQL_HASH_CHAIN_PAGE, (session_id, limit, offset)).fetchall()
+
+    @staticmethod
+    def get_anomaly_log(session_id: str, offset: int = 0, limit: int = -1):
+        with get_conn() as conn:
+            return conn.execute(SQL_ANOMALY_PAGE, (session_id, limit, offset)).fetchall()
+
+    @staticmethod
+    def invalidate_session(session_id: str):
+        with _session_cache_lock:
+            _session_cache.pop(session_id, None)
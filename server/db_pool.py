@@ -0,0 +1,62 @@
+import os
+import queue
+import sqlite3
+import logging
+from contextlib import contextmanager
+
+DB_NAME = "ppah_enterprise.db"
+logger = logging.getLogger("PPAH_DB")
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
+POOL_SIZE = min(max(int(os.getenv("PPAH_DB_POOL_SIZE", "4")), POOL_MIN_SIZE), POOL_MAX_SIZE)
+
+# Applied once per pooled connection; they persist for the connection lifetime.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+_pool: "queue.Queue[sqlite3.Connection] | None" = None
+
+
+def _connect() -> sqlite3.Connection:
+    # Autocommit: single statements commit on their own, multi-statement writes open
+    # an explicit BEGIN IMMEDIATE. The larger statement cache keeps every query this
+    # server issues compiled for the life of the connection.
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None, cached_statements=512)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def init_pool():
+    global _pool
+    if _pool is not None:
+        return
+    pool = queue.Queue(maxsize=POOL_SIZE)
+    for _ in range(POOL_SIZE):
+        pool.put(_connect())
+    _pool = pool
+    logger.info("SQLite pool ready (%d connections, WAL)", POOL_SIZE)
+
+
+@contextmanager
+def get_conn():
+    """Borrow a long-lived connection; an explicit transaction commits on success, rolls back on error."""
+    if _pool is None:
+        init_pool()
+    conn = _pool.get()
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _pool.put(conn)
@@ -1,18 +1,33 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Body
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from typing import Dict, Any
 import hashlib
-import hmac
-import secrets
-import json
+import orjson
+import asyncio
+import atexit
 import logging
+import os
+import queue
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import lru_cache
+
+from cachetools import TTLCache
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # --- NEW IMPORTS ---
 from .database import DatabaseManager
 from .models import (
-    WebAuthnResponse, InitSessionRequest, VerifyHashRequest, PPAHSession
+    EmailRequest, WebAuthnResponse, InitSessionRequest, VerifyHashRequest, BatchVerifyRequest, PPAHSession,
+    signed_message, verify_signature, apply_trust_score
 )
 from .signaling import manager
+from .batcher import batcher
+from .challenges import challenge_store
+from .ratelimit import RateLimiter
+from .redis_client import close_redis
 
 # --- WEBAUTHN LIBS ---
 from webauthn import (
@@ -26,6 +41,7 @@ from webauthn.helpers import (
     parse_registration_credential_json,
     parse_authentication_credential_json
 )
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse, WebAuthnException
 from webauthn.helpers.structs import (
     AuthenticatorSelectionCriteria,
     UserVerificationRequirement,
@@ -34,10 +50,40 @@ from webauthn.helpers.structs import (
 )
 
 # --- SETUP ---
-logging.basicConfig(level=logging.INFO)
+# Request handlers only enqueue records; formatting and the write(2) happen on the
+# QueueListener thread. Set PPAH_LOG_FILE to log to a rotating file instead of stderr,
+# and PPAH_LOG_LEVEL=WARNING in production to drop INFO records before they are queued.
+_log_queue = queue.SimpleQueue()
+_log_handler = (RotatingFileHandler(os.environ["PPAH_LOG_FILE"], maxBytes=10_000_000, backupCount=3)
+                if os.getenv("PPAH_LOG_FILE") else logging.StreamHandler())
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # full format is applied by _log_handler
+LOG_LEVEL = os.getenv("PPAH_LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, handlers=[_queue_handler])
+# uvicorn pins its access logger to INFO itself, and that is the one line per request;
+# uvicorn.run below gets the same level so it does not reset this.
+logging.getLogger("uvicorn.access").setLevel(LOG_LEVEL)
 logger = logging.getLogger("PPAH_Server")
 
-app = FastAPI(title="PPAH Enhanced Verification API - SCALABLE")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The batcher is started per lifespan so its queue binds to the loop serving requests;
+    # stopping it flushes every write queued before shutdown.
+    batcher.start()
+    try:
+        yield
+    finally:
+        await batcher.stop()
+        await close_redis()
+
+# Handlers return plain dicts; ORJSONResponse serializes them with orjson instead of
+# the stdlib json encoder.
+app = FastAPI(title="PPAH Enhanced Verification API - SCALABLE", default_response_class=ORJSONResponse,
+              lifespan=lifespan)
 
 # Config
 NGROK_DOMAIN = "jim-peaceable-inconsequently.ngrok-free.dev"
@@ -53,85 +99,123 @@ else:
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], 
+    # The client normally calls through its own origin (Next.js rewrites), so CORS only
+    # matters for direct calls. Explicit origins also make allow_credentials valid, and
+    # max_age lets browsers cache the preflight for a day.
+    allow_origins=list(dict.fromkeys([ORIGIN, "http://localhost:3000"])),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,
 )
 
 # Init DB
 DatabaseManager.init_db()
-challenge_store = {} 
+
+# Per-IP budgets for the endpoints that mint challenges, credentials and sessions.
+# A real user needs one or two calls per ceremony, so these only bite on scripted abuse.
+auth_limit = Depends(RateLimiter(times=20, seconds=60))
+session_limit = Depends(RateLimiter(times=30, seconds=60))
+# Per-email budget shared by both options endpoints, so rotating source IPs cannot
+# keep re-minting challenges for one account.
+email_limit = RateLimiter(times=10, seconds=60)
 
 # --- WEBAUTHN ROUTES ---
 
-@app.post("/api/webauthn/register/options")
-async def register_options(data: dict = Body(...)):
-    email = data.get("email")
-    if not email: raise HTTPException(400, "Email required")
-    user_id_bytes = hashlib.sha256(email.encode()).digest()
+# allowCredentials descriptors per registered email, so repeated login attempts skip
+# the DB read and object construction. register_verify drops the entry so a new
+# passkey is offered immediately; other workers pick it up within the TTL.
+_descriptor_cache = TTLCache(maxsize=10_000, ttl=60)
+
+async def _descriptors_for(email: str):
+    descriptors = _descriptor_cache.get(email)
+    if descriptors is None:
+        cred_ids = await asyncio.to_thread(DatabaseManager.get_credential, email)
+        descriptors = [PublicKeyCredentialDescriptor(id=cid, type=PublicKeyCredentialType.PUBLIC_KEY) for cid in cred_ids]
+        if descriptors:
+            _descriptor_cache[email] = descriptors
+    return descriptors
+
+@lru_cache(maxsize=4096)
+def _user_id_for(email: str) -> bytes:
+    # Stable WebAuthn user handle per email; cached so registration retries skip the hash.
+    return hashlib.sha256(email.encode()).digest()
+
+@app.post("/api/webauthn/register/options", dependencies=[auth_limit])
+async def register_options(data: EmailRequest):
+    email = data.email
+    await email_limit.check(f"options:{email}")
+    user_id_bytes = _user_id_for(email)
     options = generate_registration_options(
         rp_id=RP_ID, rp_name=RP_NAME, user_id=user_id_bytes, user_name=email,
         authenticator_selection=AuthenticatorSelectionCriteria(user_verification=UserVerificationRequirement.PREFERRED)
     )
-    challenge_store[email] = options.challenge
-    return json.loads(options_to_json(options))
+    await challenge_store.put(email, options.challenge)
+    # options_to_json already produces the response body; parsing it back into a dict
+    # only for the response class to re-encode it is wasted work.
+    return Response(options_to_json(options), media_type="application/json")
 
-@app.post("/api/webauthn/register/verify")
+@app.post("/api/webauthn/register/verify", dependencies=[auth_limit])
 async def register_verify(data: WebAuthnResponse):
     try:
         email = data.email
-        challenge = challenge_store.get(email)
+        # Challenges are single-use: taken on every attempt, whether or not it verifies.
+        challenge = await challenge_store.pop(email)
         if not challenge: raise HTTPException(400, "Challenge expired")
 
         credential = parse_registration_credential_json(data.response)
-        verification = verify_registration_response(
+        # Attestation parsing and signature checks are CPU-bound; cryptography releases
+        # the GIL inside OpenSSL, so a worker thread keeps the event loop responsive.
+        verification = await asyncio.to_thread(
+            verify_registration_response,
             credential=credential, expected_challenge=challenge, expected_origin=ORIGIN, expected_rp_id=RP_ID,
         )
-        DatabaseManager.save_credential(
-            verification.credential_id, email, 
+        await asyncio.to_thread(
+            DatabaseManager.save_credential, verification.credential_id, email,
             verification.credential_public_key, verification.sign_count
         )
-        del challenge_store[email]
+        _descriptor_cache.pop(email, None)
         return {"verified": True}
     except Exception as e:
-        logger.error(f"Reg Error: {e}")
+        logger.error("Reg Error: %s", e)
         raise HTTPException(400, f"Registration failed: {str(e)}")
 
-@app.post("/api/webauthn/login/options")
-async def login_options(data: dict = Body(...)):
-    email = data.get("email")
-    rows = DatabaseManager.get_credential(email)
-    if not rows: raise HTTPException(404, "User not registered")
+@app.post("/api/webauthn/login/options", dependencies=[auth_limit])
+async def login_options(data: EmailRequest):
+    email = data.email
+    await email_limit.check(f"options:{email}")
+    allow_credentials_list = await _descriptors_for(email)
+    if not allow_credentials_list: raise HTTPException(404, "User not registered")
     
-    allow_credentials_list = [PublicKeyCredentialDescriptor(id=row[0], type=PublicKeyCredentialType.PUBLIC_KEY) for row in rows]
     options = generate_authentication_options(
         rp_id=RP_ID, allow_credentials=allow_credentials_list, user_verification=UserVerificationRequirement.PREFERRED
     )
-    challenge_store[email] = options.challenge
-    return json.loads(options_to_json(options))
+    await challenge_store.put(email, options.challenge)
+    return Response(options_to_json(options), media_type="application/json")
 
-@app.post("/api/webauthn/login/verify")
+@app.post("/api/webauthn/login/verify", dependencies=[auth_limit])
 async def login_verify(data: WebAuthnResponse):
+    email = data.email
+    challenge = await challenge_store.pop(email)
+    if not challenge: raise HTTPException(400, "Authentication failed")
+
+    # Only malformed or unverifiable credentials are client errors; a database failure
+    # propagates as a 500 instead of being reported as a bad login.
     try:
-        email = data.email
-        challenge = challenge_store.get(email)
-        if not challenge: raise HTTPException(400, "Challenge not found")
-        
         credential = parse_authentication_credential_json(data.response)
-        row = DatabaseManager.get_credential_by_id(credential.raw_id)
-        if not row: raise HTTPException(400, "Credential not found")
-        
-        verification = verify_authentication_response(
+        row = await asyncio.to_thread(DatabaseManager.get_credential_by_id, credential.raw_id)
+        if not row: raise InvalidAuthenticationResponse("Credential not found")
+
+        verification = await asyncio.to_thread(
+            verify_authentication_response,
             credential=credential, expected_challenge=challenge, expected_origin=ORIGIN, expected_rp_id=RP_ID,
             credential_public_key=row[0], credential_current_sign_count=row[1],
         )
-        DatabaseManager.update_sign_count(verification.new_sign_count, credential.raw_id)
-        del challenge_store[email]
-        return {"verified": True, "credential_id": credential.id}
-    except Exception as e:
-        logger.error(f"Login Error: {e}")
+    except WebAuthnException as e:
+        logger.warning("Login failed: %s: %s", type(e).__name__, e)
         raise HTTPException(400, "Authentication failed")
+    await asyncio.to_thread(DatabaseManager.update_sign_count, verification.new_sign_count, credential.raw_id)
+    return {"verified": True, "credential_id": credential.id}
 
 # --- SESSION & SIGNALING ROUTES ---
 
@@ -141,56 +225,149 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
     if not success: return 
     try:
         while True:
-            data = await websocket.receive_json()
+            data = orjson.loads(await websocket.receive_text())
             await manager.broadcast(data, room_id, websocket)
     except WebSocketDisconnect:
         await manager.disconnect(websocket, room_id)
 
-@app.post('/api/session/init')
+@app.post('/api/session/init', dependencies=[session_limit])
 async def initialize_session(request: InitSessionRequest):
-    session_id = secrets.token_hex(16)
-    session_key = secrets.token_hex(32)
+    # One CSPRNG read for both values: 16 bytes of id, 32 bytes of HMAC key.
+    raw = os.urandom(48)
+    session_id, session_key = raw[:16].hex(), raw[16:].hex()
     session = PPAHSession(session_id, request.email, request.webauthn_credential_id, session_key)
-    session.save() 
+    await asyncio.to_thread(session.save)
     return {'session_id': session_id, 'session_key': session_key, 'status': 'initialized'}
 
+async def _session_auth(session_id: str):
+    # Cache hits stay on the event loop; only a miss pays for the thread hop. The cache
+    # is read again after the await so the caller sees any advance_session made by a
+    # concurrent request meanwhile, never the older DB row.
+    row = DatabaseManager.cached_session_auth(session_id)
+    if row is None:
+        row = await asyncio.to_thread(DatabaseManager.get_session_auth, session_id)
+        row = DatabaseManager.cached_session_auth(session_id) or row
+    return row
+
+def _require_batcher():
+    if not batcher.running:
+        logger.error("Rejecting verified segment: write batcher is not running")
+        raise HTTPException(503, "Verification temporarily unavailable")
+
 @app.post('/api/verify-hash')
 async def verify_hash(request: VerifyHashRequest):
-    session = PPAHSession.load(request.session_id)
-    if not session: 
+    row = await _session_auth(request.session_id)
+    if not row: 
         return {'valid': False, 'session_status': 'terminated'}
+    mac, status, segment_count = row
     
     # HMAC Validation (Security Fix)
-    message = f"{request.session_id}{request.segment_id}{request.hash}{request.trust_score}".encode('utf-8')
-    key = session.session_key.encode('utf-8')
-    expected_signature = hmac.new(key, message, hashlib.sha256).hexdigest()
-    
-    if not hmac.compare_digest(expected_signature, request.signature):
-        logger.warning(f"Invalid Signature for Session {request.session_id}")
+    message = signed_message(request.session_id, request.segment_id, request.hash, request.trust_score)
+    if not verify_signature(mac, message, request.signature):
+        logger.warning("Invalid Signature for Session %s", request.session_id)
         return {'valid': False, 'session_status': 'compromised', 'error': 'Invalid Signature'}
 
+    if request.segment_id <= segment_count:
+        return {'valid': False, 'session_status': status, 'error': 'Out-of-order Segment'}
+
     # Logic
-    session.last_trust_score = request.trust_score
-    if request.trust_score < 40:
-        session.status = "frozen"
-        session.freeze_reason = f"Low Trust Score: {request.trust_score}"
-    elif request.trust_score >= 40 and session.status == "frozen":
-        session.status = "active"
-        session.freeze_reason = None
-            
-    session.save() 
-    return {'valid': True, 'session_status': session.status}
+    status, freeze_reason, anomaly = apply_trust_score(status, request.trust_score)
+
+    # No await between the ordering check and the cache update, so concurrent
+    # requests for the same session cannot both claim a segment. submit() may wait
+    # for queue room, but only after the segment is claimed, so the batcher is checked
+    # first: a claimed segment that is never written could not be retried.
+    _require_batcher()
+    DatabaseManager.advance_session(request.session_id, mac, status, request.segment_id)
+    await batcher.submit(request.session_id, [(request.segment_id, request.hash)], request.trust_score,
+                         status, freeze_reason, [(request.segment_id, anomaly)] if anomaly else ())
+    return {'valid': True, 'session_status': status}
+
+@app.post('/api/verify-hash/batch')
+async def verify_hash_batch(request: BatchVerifyRequest):
+    """Verify up to 256 segments of one session; results are ordered by segment_id, not request order."""
+    row = await _session_auth(request.session_id)
+    if not row:
+        return {'valid': False, 'session_status': 'terminated'}
+    mac, status, segment_count = row
+
+    # One session lookup and one queued write for the whole batch; items are still
+    # verified individually so a bad signature only rejects its own segment.
+    results, accepted, anomalies = [], [], []
+    trust_score = freeze_reason = None
+    for item in sorted(request.items, key=lambda i: i.segment_id):
+        message = signed_message(request.session_id, item.segment_id, item.hash, item.trust_score)
+        if not verify_signature(mac, message, item.signature):
+            results.append({'segment_id': item.segment_id, 'valid': False, 'error': 'Invalid Signature'})
+            continue
+        if item.segment_id <= segment_count:
+            results.append({'segment_id': item.segment_id, 'valid': False, 'error': 'Out-of-order Segment'})
+            continue
+        status, freeze_reason, anomaly = apply_trust_score(status, item.trust_score)
+        if anomaly:
+            anomalies.append((item.segment_id, anomaly))
+        accepted.append((item.segment_id, item.hash))
+        segment_count, trust_score = item.segment_id, item.trust_score
+        results.append({'segment_id': item.segment_id, 'valid': True})
+
+    if accepted:
+        _require_batcher()
+        DatabaseManager.advance_session(request.session_id, mac, status, segment_count)
+        await batcher.submit(request.session_id, accepted, trust_score, status, freeze_reason, anomalies)
+
+    if any(r.get('error') == 'Invalid Signature' for r in results):
+        logger.warning("Invalid Signature in batch for Session %s", request.session_id)
+        status = 'compromised'
+    return {'valid': all(r['valid'] for r in results), 'session_status': status, 'results': results}
+
+def _iso(us: int) -> str:
+    # Timestamps are stored as epoch microseconds; ISO strings only at the API boundary.
+    return datetime.fromtimestamp(us / 1e6).isoformat()
+
+# Anomaly and chain listings grow with the session, so both endpoints return one page.
+PAGE_LIMIT = 1000
 
 @app.get('/api/session/{session_id}/security-report')
-async def get_security_report(session_id: str):
-    session = PPAHSession.load(session_id)
+async def get_security_report(session_id: str, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=PAGE_LIMIT)):
+    session = await asyncio.to_thread(PPAHSession.load, session_id)
     if not session: raise HTTPException(status_code=404)
+    anomalies = await asyncio.to_thread(DatabaseManager.get_anomaly_log, session_id, offset, limit)
     return {
         'status': session.status, 
         'score': session.last_trust_score, 
-        'freeze_reason': session.freeze_reason
+        'freeze_reason': session.freeze_reason,
+        'segment_count': session.segment_count,
+        'anomalies': [{'segment_id': a[0], 'reason': a[1], 'timestamp': _iso(a[2])} for a in anomalies]
     }
 
+def _iter_hash_chain(session_id: str, chain):
+    # Same {"session_id", "hash_chain": [...]} shape as before, encoded entry by entry
+    # so the response body is never built as one large document.
+    yield b'{"session_id":' + orjson.dumps(session_id) + b',"hash_chain":['
+    for i, c in enumerate(chain):
+        entry = orjson.dumps({'segment_id': c[0], 'hash': c[1], 'timestamp': _iso(c[2])})
+        yield entry if i == 0 else b',' + entry
+    yield b']}'
+
+@app.get('/api/session/{session_id}/hash-chain')
+async def get_hash_chain(session_id: str, offset: int = Query(0, ge=0), limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT)):
+    if not await _session_auth(session_id): raise HTTPException(status_code=404)
+    chain = await asyncio.to_thread(DatabaseManager.get_hash_chain, session_id, offset, limit)
+    return StreamingResponse(_iter_hash_chain(session_id, chain), media_type="application/json")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Challenges can move to Redis (CHALLENGE_BACKEND), but WebSocket rooms and the
+    # session auth cache are still per-process, so more than one worker is only safe
+    # behind sticky routing; the default stays at one.
+    workers = int(os.getenv("PPAH_WORKERS", "1"))
+    uvicorn.run(
+        "server.ppah_server:app" if workers > 1 else app,
+        host="0.0.0.0", port=8000, workers=workers,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools",
+        # Leave logging as configured above: uvicorn's default LOGGING_CONFIG gives the
+        # access logger its own non-propagating StreamHandler, a blocking write per request.
+        log_config=None,
+        log_level=LOG_LEVEL.lower(),
+    )
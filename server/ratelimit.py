@@ -0,0 +1,39 @@
+import time
+
+from cachetools import TTLCache
+from fastapi import HTTPException, Request
+
+from .redis_client import get_redis
+
+class RateLimiter:
+    """FastAPI dependency allowing `times` calls per `seconds` window, per client IP and route.
+
+    check() applies the same limit to any other key, e.g. a request field.
+
+    Counts live in Redis (one INCR + EXPIRE pipeline per call) when REDIS_URL is set,
+    so every worker shares them; otherwise in a bounded per-process TTLCache. The
+    client IP is what uvicorn reports, which already honours X-Forwarded-For from
+    the local Next.js proxy (uvicorn's default forwarded_allow_ips).
+    """
+
+    def __init__(self, times: int, seconds: int):
+        self.times = times
+        self.seconds = seconds
+        self.counts: TTLCache = TTLCache(maxsize=100_000, ttl=seconds)
+
+    async def __call__(self, request: Request):
+        host = request.client.host if request.client else "-"
+        await self.check(f"{request.url.path}:{host}")
+
+    async def check(self, scope: str):
+        window = int(time.time()) // self.seconds
+        key = f"rl:{scope}:{window}"
+        redis = get_redis()
+        if redis is not None:
+            async with redis.pipeline(transaction=True) as pipe:
+                count, _ = await pipe.incr(key).expire(key, self.seconds).execute()
+        else:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+        if count > self.times:
+            raise HTTPException(429, "Too many requests")
@@ -0,0 +1,20 @@
+import os
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+_client = None
+
+def get_redis():
+    """Process-wide redis.asyncio client for REDIS_URL, or None when Redis is not configured."""
+    global _client
+    if _client is None and REDIS_URL:
+        # Imported here so redis stays an optional dependency of the in-memory setup.
+        import redis.asyncio as redis
+        _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+async def close_redis():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
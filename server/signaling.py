@@ -1,38 +1,50 @@
+import asyncio
+import orjson
 from fastapi import WebSocket
-from typing import Dict, List
+from typing import Dict, Set
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self._cleanup_tasks: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket, room_id: str):
         await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        
-        if len(self.active_connections[room_id]) >= 2:
+        room = self.active_connections.get(room_id)
+        if room is not None and len(room) >= 2:
             await websocket.send_json({"type": "error", "message": "ROOM_FULL"})
             await websocket.close(code=1008)
             return False
 
-        self.active_connections[room_id].append(websocket)
+        self.active_connections.setdefault(room_id, set()).add(websocket)
         return True
 
     async def disconnect(self, websocket: WebSocket, room_id: str):
-        if room_id in self.active_connections:
-            if websocket in self.active_connections[room_id]:
-                self.active_connections[room_id].remove(websocket)
-                await self.broadcast({"type": "peer_left"}, room_id, websocket)
-            if not self.active_connections[room_id]:
-                del self.active_connections[room_id]
+        room = self.active_connections.get(room_id)
+        if room is None:
+            return
+        if websocket in room:
+            room.discard(websocket)
+            await self.broadcast({"type": "peer_left"}, room_id, websocket)
+        # Identity check: while peer_left was being sent this room may have been emptied
+        # and deleted by the other peer, and a fresh one created under the same id.
+        if not room and self.active_connections.get(room_id) is room:
+            del self.active_connections[room_id]
 
     async def broadcast(self, message: dict, room_id: str, sender: WebSocket):
         if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                if connection != sender:
-                    try:
-                        await connection.send_json(message)
-                    except RuntimeError:
-                        pass 
+            # Encode once and send to every peer concurrently. Text frames, because the
+            # client JSON.parse()s event.data; a failed peer must not stall the others.
+            payload = orjson.dumps(message).decode()
+            targets = [c for c in self.active_connections[room_id] if c is not sender]
+            results = await asyncio.gather(*(c.send_text(payload) for c in targets), return_exceptions=True)
+            for connection, result in zip(targets, results):
+                if isinstance(result, Exception):
+                    # A dead peer is dropped (and peer_left sent) in its own task rather than
+                    # recursing into broadcast from here; disconnect() is idempotent if the
+                    # peer's own receive loop gets there too.
+                    task = asyncio.create_task(self.disconnect(connection, room_id))
+                    self._cleanup_tasks.add(task)
+                    task.add_done_callback(self._cleanup_tasks.discard)
 
 manager = ConnectionManager()
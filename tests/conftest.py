@@ -0,0 +1,41 @@
+import hashlib
+import hmac
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def sign(session_id, session_key, segment_id, digest, trust_score):
+    """Hex HMAC exactly as the browser client computes it."""
+    message = f"{session_id}{segment_id}{digest}{trust_score}".encode()
+    return hmac.new(session_key.encode(), message, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    # DB_NAME is relative and the pool opens it on import, so import the server from a
+    # scratch directory to keep the test database out of the checkout.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("db"))
+    try:
+        from server.ppah_server import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    from server import ppah_server
+
+    # Every TestClient reports the same host, so start each test with fresh budgets.
+    for limiter in (ppah_server.auth_limit.dependency, ppah_server.session_limit.dependency, ppah_server.email_limit):
+        limiter.counts.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+def new_session(client):
+    session = client.post("/api/session/init", json={"email": "a@b.c", "webauthn_credential_id": "x"}).json()
+    return session["session_id"], session["session_key"]
@@ -0,0 +1,141 @@
+import asyncio
+import sys
+import types
+
+from fastapi.testclient import TestClient
+
+from conftest import new_session, sign
+
+
+def _verify_one(client):
+    sid, key = new_session(client)
+    digest = "ab" * 32
+    result = client.post("/api/verify-hash", json={"session_id": sid, "segment_id": 1, "hash": digest,
+                                                   "trust_score": 90, "signature": sign(sid, key, 1, digest, 90)})
+    assert result.json()["valid"] is True
+    return sid
+
+
+def test_writes_persist_across_lifespans(app):
+    # The batcher's queue must bind to each lifespan's loop, not the first one it saw.
+    from server.database import DatabaseManager
+
+    for _ in range(2):
+        with TestClient(app) as client:
+            sid = _verify_one(client)
+        # Leaving the lifespan flushes the batcher, so the write is already in SQLite.
+        DatabaseManager.invalidate_session(sid)
+        assert DatabaseManager.load_session(sid)[4] == 1
+
+
+def test_batching_survives_restart(monkeypatch):
+    from server.batcher import SessionWriteBatcher
+
+    batches = []
+    monkeypatch.setattr(SessionWriteBatcher, "_flush", staticmethod(lambda items: batches.append(len(items))))
+
+    async def cycle(batcher):
+        batcher.start()
+        for i in range(3):
+            await batcher.submit(f"s{i}", [], 90, "active", None)
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.1)
+        await batcher.stop()
+
+    batcher = SessionWriteBatcher()
+    asyncio.run(cycle(batcher))
+    asyncio.run(cycle(batcher))
+    # Every cycle coalesces its writes into one batch rather than flushing them one by one.
+    assert [n for n in batches if n] == [3, 3]
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis, and as strict about loops: a client is
+    bound to the first loop that uses it and is unusable once closed."""
+
+    data = {}
+
+    def __init__(self):
+        self.loop = None
+        self.closed = False
+
+    @classmethod
+    def from_url(cls, url):
+        return cls()
+
+    def _use(self):
+        assert not self.closed, "client used after aclose()"
+        self.loop = self.loop or asyncio.get_running_loop()
+        assert self.loop is asyncio.get_running_loop(), "client used on a different event loop"
+
+    async def set(self, key, value, ex=None):
+        self._use()
+        self.data[key] = value
+
+    async def getdel(self, key):
+        self._use()
+        return self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.keys = redis, []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def incr(self, key):
+        self.keys.append(key)
+        return self
+
+    def expire(self, key, seconds):
+        return self
+
+    async def execute(self):
+        self.redis._use()
+        key = self.keys[0]
+        self.redis.data[key] = self.redis.data.get(key, 0) + 1
+        return [self.redis.data[key], True]
+
+
+def test_redis_challenges_across_lifespans(app, monkeypatch):
+    from server import ppah_server, redis_client
+    from server.challenges import RedisChallengeStore
+
+    fake = types.ModuleType("redis.asyncio")
+    fake.Redis = FakeRedis
+    monkeypatch.setitem(sys.modules, "redis", types.ModuleType("redis"))
+    monkeypatch.setitem(sys.modules, "redis.asyncio", fake)
+    monkeypatch.setattr(redis_client, "REDIS_URL", "redis://fake")
+    monkeypatch.setattr(ppah_server, "challenge_store", RedisChallengeStore())
+    FakeRedis.data.clear()
+
+    # close_redis() ends each lifespan, so the second one has to use a fresh client.
+    for _ in range(2):
+        with TestClient(app) as client:
+            assert client.post("/api/webauthn/register/options", json={"email": "r@x"}).status_code == 200
+            assert "chal:r@x" in FakeRedis.data
+            assert client.post("/api/webauthn/register/verify", json={"email": "r@x", "response": {}}).status_code == 400
+            assert "chal:r@x" not in FakeRedis.data
+
+
+def test_segment_not_claimed_without_batcher(app):
+    # Without a lifespan the batcher is not running: the request must fail before the
+    # segment is claimed, so the client can retry the same segment_id later.
+    with TestClient(app) as client:
+        sid, key = new_session(client)
+    digest = "cd" * 32
+    body = {"session_id": sid, "segment_id": 1, "hash": digest, "trust_score": 90,
+            "signature": sign(sid, key, 1, digest, 90)}
+    assert TestClient(app).post("/api/verify-hash", json=body).status_code == 503
+    with TestClient(app) as client:
+        assert client.post("/api/verify-hash", json=body).json()["valid"] is True
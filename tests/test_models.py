@@ -0,0 +1,29 @@
+import hmac
+
+import pytest
+from pydantic import ValidationError
+
+from conftest import sign
+from server.models import InitSessionRequest, signed_message, verify_signature
+
+
+def test_init_session_accepts_long_credential_ids():
+    # WebAuthn credential IDs go up to 1023 bytes, ~1364 base64url characters.
+    InitSessionRequest(email="a@b.c", webauthn_credential_id="A" * 1364)
+    with pytest.raises(ValidationError):
+        InitSessionRequest(email="a@b.c", webauthn_credential_id="A" * 1401)
+    with pytest.raises(ValidationError):
+        InitSessionRequest(email="a" * 257, webauthn_credential_id="x")
+
+
+def test_verify_signature():
+    session_id, key, digest = "s1", "ab" * 32, "cd" * 32
+    # Same keyed template the session cache hands out (database._auth_entry).
+    mac = hmac.new(key.encode(), digestmod="sha256")
+    message = signed_message(session_id, 7, digest, 90)
+    good = bytes.fromhex(sign(session_id, key, 7, digest, 90))
+
+    assert verify_signature(mac, message, good)
+    assert not verify_signature(mac, message, good[:-1] + bytes([good[-1] ^ 1]))
+    assert not verify_signature(mac, message, good[:-1])
+    assert not verify_signature(mac, message, good + b"\0")
@@ -0,0 +1,28 @@
+import types
+
+import pytest
+
+from server import ratelimit
+
+
+@pytest.fixture(autouse=True)
+def fixed_window(monkeypatch):
+    # Pin the clock so a test never straddles a window boundary.
+    monkeypatch.setattr(ratelimit, "time", types.SimpleNamespace(time=lambda: 1_000_000.0))
+
+
+def test_per_ip_limit_returns_429(client):
+    body = {"email": "a@b.c", "webauthn_credential_id": "x"}
+    codes = [client.post("/api/session/init", json=body).status_code for _ in range(31)]
+    assert codes == [200] * 30 + [429]
+
+
+def test_per_email_budget_is_shared_by_options_endpoints(client):
+    # Unregistered, so login/options answers 404, but the call still counts.
+    body = {"email": "shared@x"}
+    for _ in range(5):
+        assert client.post("/api/webauthn/register/options", json=body).status_code == 200
+        assert client.post("/api/webauthn/login/options", json=body).status_code == 404
+    assert client.post("/api/webauthn/register/options", json=body).status_code == 429
+    assert client.post("/api/webauthn/login/options", json=body).status_code == 429
+    assert client.post("/api/webauthn/register/options", json={"email": "other@x"}).status_code == 200
@@ -0,0 +1,47 @@
+from conftest import new_session, sign
+
+DIGEST = "ef" * 32
+
+
+def _item(sid, key, segment_id, trust_score=90, signature=None):
+    return {"segment_id": segment_id, "hash": DIGEST, "trust_score": trust_score,
+            "signature": signature or sign(sid, key, segment_id, DIGEST, trust_score)}
+
+
+def _batch(client, sid, items):
+    return client.post("/api/verify-hash/batch", json={"session_id": sid, "items": items})
+
+
+def test_results_are_ordered_by_segment_id(client):
+    sid, key = new_session(client)
+    out = _batch(client, sid, [_item(sid, key, seg) for seg in (3, 1, 2)]).json()
+    assert [r["segment_id"] for r in out["results"]] == [1, 2, 3]
+    assert out["valid"] is True and out["session_status"] == "active"
+
+
+def test_duplicate_segment_is_out_of_order(client):
+    sid, key = new_session(client)
+    out = _batch(client, sid, [_item(sid, key, 1), _item(sid, key, 1)]).json()
+    assert out["results"] == [{"segment_id": 1, "valid": True},
+                              {"segment_id": 1, "valid": False, "error": "Out-of-order Segment"}]
+    assert out["valid"] is False
+
+
+def test_bad_signature_rejects_only_its_item(client):
+    sid, key = new_session(client)
+    items = [_item(sid, key, 1), _item(sid, key, 2, signature="00" * 32), _item(sid, key, 3)]
+    out = _batch(client, sid, items).json()
+    assert [r["valid"] for r in out["results"]] == [True, False, True]
+    assert out["results"][1]["error"] == "Invalid Signature"
+    assert out["valid"] is False and out["session_status"] == "compromised"
+    # Segments 1 and 3 were accepted, so 3 is now taken and 4 is next.
+    again = _batch(client, sid, [_item(sid, key, 3), _item(sid, key, 4)]).json()
+    assert [r["valid"] for r in again["results"]] == [False, True]
+
+
+def test_batch_size_bounds(client):
+    sid, key = new_session(client)
+    assert _batch(client, sid, []).status_code == 422
+    assert _batch(client, sid, [_item(sid, key, seg) for seg in range(1, 258)]).status_code == 422
+    out = _batch(client, sid, [_item(sid, key, seg) for seg in range(1, 257)]).json()
+    assert len(out["results"]) == 256 and out["valid"] is True